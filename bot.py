@@ -1,11 +1,14 @@
+import asyncio
 import io
 import os
 import re
 import time
 import sqlite3
 from datetime import date, datetime, time as dt_time, timedelta
-from threading import Thread
-from typing import Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+from operator import itemgetter
+from threading import Lock, Thread
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from zoneinfo import ZoneInfo
 
 import requests
@@ -47,11 +50,76 @@ def keep_alive():
 DEFAULT_TIMEZONE = "Asia/Krasnoyarsk"
 DEFAULT_GROUP = "ИГ25-01Б-ОМ"
 
-DATE_RE = re.compile(r"\b(\d{1,2})[.\-/](\d{1,2})(?:[.\-/](\d{2,4}))?\b")
-TIME_RE = re.compile(r"(\d{1,2})[.:](\d{2})\s*[–—-]\s*(\d{1,2})[.:](\d{2})")
+# Заголовок расписания ищем только в первых строках листа
+HEADER_SCAN_ROWS = 120
+
+TIME_RE = re.compile(r"([0-9]{1,2})[.:]([0-9]{2})(?:\s*[–—-]\s*([0-9]{1,2})[.:]([0-9]{2}))?")
+# Повторяющиеся разделители ("30..01", "30-/01") допускаются прямо в шаблоне
+DDMM_RE = re.compile(r"([0-9]{1,2})[.\-/]+([0-9]{1,2})")
+TEXT_DAY_RE = re.compile(r"^(?:день\s+)?([0-9]{1,2}[.\-/][0-9]{1,2}(?:[.\-/][0-9]{2,4})?)$")
+TEXT_DAY_MAX_LEN = 32
+WHITESPACE_RE = re.compile(r"\s+")
+NON_WORD_RE = re.compile(r"[^а-яa-z0-9]+")
+# Строка, которую приклеиваем к предыдущей: вид занятия ("пр", "лек ...") или "/ауд."
+GLUE_RE = re.compile(r"^(?:(?:пр|лек|лаб|сем)\b|/)", re.IGNORECASE)
+TIME_START_RE = re.compile(r"^([0-9]{1,2})[.:]([0-9]{2})")
+GROUP_CODE_RE = re.compile(r"\b[А-ЯЁA-Z]{1,6}[0-9]{2}-[0-9]{2}")
+SPREADSHEET_ID_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
+
+# Служебный текст шапки, который не относится к парам
+# ("вид занятия/аудитория" покрывается фрагментом "вид занятия")
+TRASH_RE = re.compile(
+    r"утверждаю|семестр|расписание|проректор|директор|учебный год|вид занятия|аудитория"
+)
 
-_CACHE_ROWS: Optional[List[List[str]]] = None
-_CACHE_TS: float = 0.0
+MONTHS_GENITIVE = {
+    "01": "января",
+    "02": "февраля",
+    "03": "марта",
+    "04": "апреля",
+    "05": "мая",
+    "06": "июня",
+    "07": "июля",
+    "08": "августа",
+    "09": "сентября",
+    "10": "октября",
+    "11": "ноября",
+    "12": "декабря",
+}
+
+GROUP_TRANS = str.maketrans({"—": "-", "–": "-"})
+
+CacheKey = Tuple[str, str, Optional[str]]
+HeaderInfo = Tuple[int, int, int, List[int]]
+TeacherHeaderInfo = Tuple[int, int, int, Dict[str, List[int]]]
+ScheduleIndex = Dict[str, List[Tuple[str, str]]]
+# dd.mm -> [(первая строка, строка после последней, время перед началом)]
+DateRanges = Dict[str, List[Tuple[int, int, Optional[str]]]]
+
+# Каждое скачивание таблицы получает новый номер версии;
+# всё, что посчитано по строкам, хранится вместе с этим номером
+# key -> (время скачивания, версия, строки, заголовки для условного GET)
+_CACHE: Dict[CacheKey, Tuple[float, int, List[List[str]], Dict[str, str]]] = {}
+_CACHE_VERSION: int = 0
+_INDEX_CACHE: Dict[CacheKey, Tuple[int, ScheduleIndex]] = {}
+_TEACHER_CACHE: Dict[CacheKey, Tuple[int, Tuple[TeacherHeaderInfo, DateRanges]]] = {}
+# Скачивания и пересчёты, которые уже идут: параллельные запросы ждут их, а не повторяют
+_PENDING_FETCHES: Dict[CacheKey, asyncio.Task] = {}
+_PENDING_BUILDS: Dict[Tuple[int, CacheKey, int], asyncio.Task] = {}
+
+# Одна сессия на все скачивания: соединение с Google переиспользуется
+HTTP_SESSION = requests.Session()
+# Разные таблицы качаются в разных потоках, а Session не обещает потокобезопасность:
+# сам запрос идёт под замком, разбор xlsx — параллельно
+HTTP_LOCK = Lock()
+
+# Сколько разных таблиц (url, группа, лист) держим в памяти одновременно
+CACHE_MAX_SHEETS = 8
+
+# Готовые ответы студентам: (версия, группа, dd.mm) -> текст.
+# Старые версии сами вытесняются, когда словарь упирается в лимит
+_FORMATTED_CACHE: Dict[Tuple[int, str, str], str] = {}
+FORMATTED_CACHE_MAX = 256
 
 
 # =========================
@@ -203,41 +271,48 @@ def get_tz() -> ZoneInfo:
     return ZoneInfo(tz_name)
 
 
+@lru_cache(maxsize=8)
+def ddmm_for_second(second: int, days: int) -> str:
+    return (datetime.now(get_tz()) + timedelta(days=days)).strftime("%d.%m")
+
+
+def today_ddmm(days: int = 0) -> str:
+    # Дата с точностью до секунды: пачка запросов в одну секунду считает её один раз
+    return ddmm_for_second(int(time.time()), days)
+
+
 def norm(value: object) -> str:
     return str(value or "").replace("\xa0", " ").strip()
 
 
+# Одни и те же названия групп (и GROUP_NAME в should_skip_cell_text)
+# нормализуются для каждой ячейки — запоминаем результат
+@lru_cache(maxsize=1024)
 def norm_group(value: object) -> str:
-    text = norm(value)
-    text = text.replace("—", "-").replace("–", "-")
-    text = re.sub(r"\s+", " ", text)
-    return text.upper()
+    # split() без аргументов режет и по \xa0, и по краям — norm() не нужен
+    text = str(value or "").translate(GROUP_TRANS)
+    return " ".join(text.split()).upper()
 
 
 def compact_spaces(text: str) -> str:
-    text = (text or "").replace("\xa0", " ").replace("\t", " ")
-    text = re.sub(r"[ ]{2,}", " ", text)
-    return text.strip()
+    # split() без аргументов режет по любым юникодным пробелам (NBSP, табы, U+2009, U+202F...),
+    # так что все они становятся обычным пробелом — и в тексте, и при дедупликации строк
+    return " ".join((text or "").split())
 
 
 def norm_teacher_text(value: object) -> str:
     text = norm(value).lower()
     text = text.replace("ё", "е")
     text = text.replace("—", "-").replace("–", "-")
-    text = re.sub(r"[^а-яa-z0-9]+", " ", text)
-    text = re.sub(r"\s+", " ", text)
+    text = NON_WORD_RE.sub(" ", text)
+    text = WHITESPACE_RE.sub(" ", text)
     return text.strip()
 
 
 def parse_ddmm(text: object) -> Optional[str]:
-    raw = norm(text)
+    raw = norm(text).replace(" ", "")
 
-    raw = raw.replace(" ", "")
-    raw = re.sub(r"\.+", ".", raw)
-    raw = re.sub(r"[-/]{2,}", "-", raw)
-    raw = re.sub(r"[.\-/]{2,}", ".", raw)
-
-    match = re.search(r"(\d{1,2})[.\-/](\d{1,2})(?:[.\-/](\d{2,4}))?", raw)
+    match = DDMM_RE.search(raw)
     if not match:
         return None
 
@@ -251,19 +326,27 @@ def parse_ddmm(text: object) -> Optional[str]:
 
 
 def normalize_time(text: object) -> Optional[str]:
-    raw = norm(text)
-    raw = raw.replace("—", "-").replace("–", "-")
-    match = TIME_RE.search(raw)
+    match = TIME_RE.search(norm(text))
     if not match:
         return None
 
     h1, m1, h2, m2 = match.groups()
+
+    # Ячейка времени в xlsx приходит как одно "08:30", без конца пары.
+    # Одиночное время принимаем только через ":" и в пределах суток,
+    # иначе дата вида "30.01" в колонке часов сошла бы за время
+    if h2 is None:
+        if match.group(0)[len(h1)] != ":" or int(h1) > 23 or int(m1) > 59:
+            return None
+
+        return f"{int(h1):02d}:{m1}"
+
     return f"{int(h1):02d}:{m1}–{int(h2):02d}:{m2}"
 
 
 def to_xlsx_export_url(url: str) -> str:
     url = url.strip()
-    match = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url)
+    match = SPREADSHEET_ID_RE.search(url)
     if not match:
         return url
 
@@ -289,35 +372,57 @@ def cell_to_text(value: object) -> str:
     return str(value)
 
 
-def worksheet_to_rows(ws) -> List[List[str]]:
+def worksheet_to_rows(ws, limit: Optional[int] = None) -> List[List[str]]:
+    last_row = ws.max_row if limit is None else min(limit, ws.max_row)
     merged_values: Dict[Tuple[int, int], object] = {}
 
     for merged_range in ws.merged_cells.ranges:
         min_col, min_row, max_col, max_row = merged_range.bounds
+
+        if min_row > last_row:
+            continue
+
         top_left_value = ws.cell(min_row, min_col).value
 
-        for row_idx in range(min_row, max_row + 1):
+        for row_idx in range(min_row, min(max_row, last_row) + 1):
             for col_idx in range(min_col, max_col + 1):
                 merged_values[(row_idx, col_idx)] = top_left_value
 
     rows: List[List[str]] = []
 
-    for row_idx in range(1, ws.max_row + 1):
+    # iter_rows(values_only=True) отдаёт готовые кортежи значений,
+    # без создания объекта ячейки на каждый ws.cell(...)
+    for row_idx, values in enumerate(
+        ws.iter_rows(max_row=last_row, max_col=ws.max_column, values_only=True),
+        start=1,
+    ):
         row: List[str] = []
 
-        for col_idx in range(1, ws.max_column + 1):
-            value = ws.cell(row_idx, col_idx).value
-
+        for col_idx, value in enumerate(values, start=1):
             if value in (None, "") and (row_idx, col_idx) in merged_values:
                 value = merged_values[(row_idx, col_idx)]
 
-            row.append(cell_to_text(value))
+            # Ячейки нормализуются один раз здесь, дальше norm() по ним не нужен
+            row.append(norm(cell_to_text(value)))
 
         rows.append(row)
 
     return rows
 
 
+def pad_rows(rows: List[List[str]], width: int) -> List[List[str]]:
+    return [row if len(row) >= width else row + [""] * (width - len(row)) for row in rows]
+
+
+def columns_getter(cols: List[int]) -> Callable[[List[str]], Tuple[str, ...]]:
+    # itemgetter с одним индексом вернул бы значение, а не кортеж
+    if len(cols) == 1:
+        col = cols[0]
+        return lambda row: (row[col],)
+
+    return itemgetter(*cols)
+
+
 def find_col_by_keywords(row_lower: List[str], keywords: List[str]) -> Optional[int]:
     for idx, cell in enumerate(row_lower):
         for keyword in keywords:
@@ -327,30 +432,84 @@ def find_col_by_keywords(row_lower: List[str], keywords: List[str]) -> Optional[
     return None
 
 
+def find_date_time_cols(row: List[str]) -> Optional[Tuple[int, int]]:
+    # Сначала одна проверка по всей строке: заголовок — одна строка из сотни
+    joined = "|".join(row).lower()
+
+    if "дата" not in joined or ("часы" not in joined and "время" not in joined):
+        return None
+
+    # Ячейки уже нормализованы в worksheet_to_rows
+    row_lower = [cell.lower() for cell in row]
+
+    date_col = find_col_by_keywords(row_lower, ["дата"])
+    time_col = find_col_by_keywords(row_lower, ["часы", "время"])
+
+    if date_col is None or time_col is None:
+        return None
+
+    return date_col, time_col
+
+
+def find_header_row(rows: List[List[str]]) -> Optional[Tuple[int, int, int]]:
+    for i in range(min(HEADER_SCAN_ROWS, len(rows))):
+        cols = find_date_time_cols(rows[i])
+
+        if cols is not None:
+            return i, cols[0], cols[1]
+
+    return None
+
+
 def sheet_looks_like_schedule(rows: List[List[str]], group_name: str) -> bool:
     target_group = norm_group(group_name)
 
-    for i in range(min(120, len(rows))):
-        row = [norm(cell) for cell in rows[i]]
-        row_lower = [cell.lower() for cell in row]
+    for i in range(min(HEADER_SCAN_ROWS, len(rows))):
+        row = rows[i]
 
-        has_date = find_col_by_keywords(row_lower, ["дата"]) is not None
-        has_time = find_col_by_keywords(row_lower, ["часы", "время"]) is not None
         has_group = any(target_group == norm_group(cell) for cell in row)
 
-        if has_date and has_time and has_group:
+        if has_group and find_date_time_cols(row) is not None:
             return True
 
     return False
 
 
-def fetch_sheet_rows(url: str, group_name: str, sheet_name: Optional[str] = None) -> List[List[str]]:
+def fetch_sheet_rows(
+    url: str,
+    group_name: str,
+    sheet_name: Optional[str] = None,
+    validators: Optional[Dict[str, str]] = None,
+) -> Optional[Tuple[List[List[str]], Dict[str, str]]]:
     export_url = to_xlsx_export_url(url)
 
-    response = requests.get(export_url, timeout=30)
+    # С заголовками прошлого ответа сервер может ответить 304 — таблица не менялась
+    with HTTP_LOCK:
+        response = HTTP_SESSION.get(export_url, timeout=30, headers=validators or {})
+
+    if response.status_code == 304:
+        return None
+
     response.raise_for_status()
 
-    workbook = load_workbook(io.BytesIO(response.content), data_only=True)
+    new_validators: Dict[str, str] = {}
+
+    if response.headers.get("ETag"):
+        new_validators["If-None-Match"] = response.headers["ETag"]
+
+    if response.headers.get("Last-Modified"):
+        new_validators["If-Modified-Since"] = response.headers["Last-Modified"]
+
+    return rows_from_workbook(response.content, group_name, sheet_name), new_validators
+
+
+def rows_from_workbook(
+    content: bytes,
+    group_name: str,
+    sheet_name: Optional[str] = None,
+) -> List[List[str]]:
+    # Внешние ссылки книги боту не нужны — не тратим время на их разбор
+    workbook = load_workbook(io.BytesIO(content), data_only=True, keep_links=False)
 
     if sheet_name:
         if sheet_name not in workbook.sheetnames:
@@ -362,15 +521,17 @@ def fetch_sheet_rows(url: str, group_name: str, sheet_name: Optional[str] = None
         worksheet = workbook[sheet_name]
         return worksheet_to_rows(worksheet)
 
+    # Для опознания листа хватает его начала; целиком переводим только найденный
     for ws in workbook.worksheets:
-        rows = worksheet_to_rows(ws)
-        if sheet_looks_like_schedule(rows, group_name):
-            return rows
+        head_rows = worksheet_to_rows(ws, limit=HEADER_SCAN_ROWS)
+
+        if sheet_looks_like_schedule(head_rows, group_name):
+            return worksheet_to_rows(ws)
 
     available = ", ".join(workbook.sheetnames)
-    first_sheet_rows = worksheet_to_rows(workbook.worksheets[0])
+    first_sheet_rows = worksheet_to_rows(workbook.worksheets[0], limit=10)
     preview = "\n".join(
-        " | ".join([norm(cell) for cell in first_sheet_rows[k][:12]])
+        " | ".join(first_sheet_rows[k][:12])
         for k in range(min(10, len(first_sheet_rows)))
     )
 
@@ -381,48 +542,177 @@ def fetch_sheet_rows(url: str, group_name: str, sheet_name: Optional[str] = None
     )
 
 
-def get_rows_with_cache(url: str, group_name: str, sheet_name: Optional[str]) -> List[List[str]]:
-    global _CACHE_ROWS, _CACHE_TS
-
+def get_cached_rows(key: CacheKey) -> Optional[Tuple[int, List[List[str]]]]:
     cache_seconds = int(os.getenv("CACHE_SECONDS", "60") or "60")
-    now = time.time()
-
-    if _CACHE_ROWS is not None and (now - _CACHE_TS) < cache_seconds:
-        return _CACHE_ROWS
+    cached = _CACHE.get(key)
 
-    rows = fetch_sheet_rows(url, group_name, sheet_name)
-    _CACHE_ROWS = rows
-    _CACHE_TS = now
+    if cached is not None and (time.time() - cached[0]) < cache_seconds:
+        return cached[1], cached[2]
 
-    return rows
+    return None
 
 
-def find_header_and_group_cols(
+def store_rows(
+    key: CacheKey,
     rows: List[List[str]],
+    validators: Dict[str, str],
+    version: Optional[int] = None,
+) -> int:
+    global _CACHE_VERSION
+
+    # Версия остаётся прежней, если сервер подтвердил, что таблица не менялась
+    if version is None:
+        _CACHE_VERSION += 1
+        version = _CACHE_VERSION
+
+    # Перевставка держит словарь упорядоченным по времени скачивания
+    _CACHE.pop(key, None)
+    _CACHE[key] = (time.time(), version, rows, validators)
+
+    while len(_CACHE) > CACHE_MAX_SHEETS:
+        oldest_key = next(iter(_CACHE))
+        del _CACHE[oldest_key]
+        _INDEX_CACHE.pop(oldest_key, None)
+        _TEACHER_CACHE.pop(oldest_key, None)
+
+    return version
+
+
+async def run_coalesced(pending: Dict, key: object, make_coro: Callable[[], Awaitable]):
+    task = pending.get(key)
+
+    if task is None:
+        task = asyncio.create_task(make_coro())
+        pending[key] = task
+        task.add_done_callback(lambda _: pending.pop(key, None))
+
+    # shield: отмена одного ожидающего не должна обрывать общую задачу
+    return await asyncio.shield(task)
+
+
+async def refresh_rows(
+    key: CacheKey,
+    url: str,
     group_name: str,
-) -> Tuple[int, int, int, List[int]]:
-    target_group = norm_group(group_name)
+    sheet_name: Optional[str],
+) -> Tuple[int, List[List[str]]]:
+    stale = _CACHE.get(key)
+    validators = stale[3] if stale is not None else None
+
+    # Скачивание и разбор xlsx блокируют, поэтому уходят в отдельный поток
+    fetched = await asyncio.to_thread(
+        fetch_sheet_rows,
+        url,
+        group_name,
+        sheet_name,
+        validators,
+    )
+
+    if fetched is None and stale is not None:
+        _, version, rows, validators = stale
+        store_rows(key, rows, validators, version)
+        return version, rows
+
+    if fetched is None:
+        raise RuntimeError("Сервер ответил 304 без сохранённой копии таблицы.")
+
+    rows, validators = fetched
+    version = store_rows(key, rows, validators)
+
+    return version, rows
+
+
+async def get_rows_with_cache(
+    url: str,
+    group_name: str,
+    sheet_name: Optional[str],
+) -> Tuple[int, List[List[str]]]:
+    key = (url, group_name, sheet_name)
+    cached = get_cached_rows(key)
+
+    if cached is not None:
+        return cached
+
+    return await run_coalesced(
+        _PENDING_FETCHES,
+        key,
+        lambda: refresh_rows(key, url, group_name, sheet_name),
+    )
 
-    header_row_idx: Optional[int] = None
-    date_col: Optional[int] = None
-    time_col: Optional[int] = None
 
-    for i in range(min(120, len(rows))):
-        row = [norm(cell) for cell in rows[i]]
-        row_lower = [cell.lower() for cell in row]
+async def get_for_version(cache: Dict, key: CacheKey, version: int, build: Callable[[], object]):
+    cached = cache.get(key)
+
+    # Пересчитываем, только если таблица была перекачана
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # Проход по всей таблице — тоже в отдельном потоке, чтобы не держать бота
+    value = await run_coalesced(
+        _PENDING_BUILDS,
+        (id(cache), key, version),
+        lambda: asyncio.to_thread(build),
+    )
 
-        found_date_col = find_col_by_keywords(row_lower, ["дата"])
-        found_time_col = find_col_by_keywords(row_lower, ["часы", "время"])
+    # Пока считали, другой запрос мог положить результат для более новой версии
+    current = cache.get(key)
 
-        if found_date_col is not None and found_time_col is not None:
-            header_row_idx = i
-            date_col = found_date_col
-            time_col = found_time_col
-            break
+    if current is None or current[0] <= version:
+        cache[key] = (version, value)
 
-    if header_row_idx is None or date_col is None or time_col is None:
+    return value
+
+
+async def get_schedule_index_with_cache(
+    url: str,
+    group_name: str,
+    sheet_name: Optional[str],
+) -> Tuple[int, ScheduleIndex]:
+    version, rows = await get_rows_with_cache(url, group_name, sheet_name)
+
+    index = await get_for_version(
+        _INDEX_CACHE,
+        (url, group_name, sheet_name),
+        version,
+        lambda: build_schedule_index(rows, group_name),
+    )
+
+    return version, index
+
+
+def build_teacher_lookup(rows: List[List[str]]) -> Tuple[TeacherHeaderInfo, DateRanges]:
+    header = find_header_and_all_group_cols(rows)
+    return header, build_date_ranges(rows, header)
+
+
+async def get_teacher_rows_with_cache(
+    url: str,
+    group_name: str,
+    sheet_name: Optional[str],
+) -> Tuple[List[List[str]], TeacherHeaderInfo, DateRanges]:
+    version, rows = await get_rows_with_cache(url, group_name, sheet_name)
+
+    header, date_ranges = await get_for_version(
+        _TEACHER_CACHE,
+        (url, group_name, sheet_name),
+        version,
+        lambda: build_teacher_lookup(rows),
+    )
+
+    return rows, header, date_ranges
+
+
+def find_header_and_group_cols(
+    rows: List[List[str]],
+    group_name: str,
+) -> HeaderInfo:
+    target_group = norm_group(group_name)
+
+    header = find_header_row(rows)
+
+    if header is None:
         preview = "\n".join(
-            " | ".join([norm(cell) for cell in rows[k][:12]])
+            " | ".join(rows[k][:12])
             for k in range(min(10, len(rows)))
         )
         raise RuntimeError(
@@ -430,13 +720,22 @@ def find_header_and_group_cols(
             f"Первые строки таблицы:\n{preview}"
         )
 
+    header_row_idx, date_col, time_col = header
+
     group_cols: List[int] = []
     search_until = min(header_row_idx + 30, len(rows))
 
+    # Подходящая ячейка обязательно содержит первый кусок названия ("ИГ25"),
+    # остальные отсеиваем до полной нормализации
+    probe = (target_group.replace("-", " ").split() or [""])[0]
+
     for i in range(header_row_idx, search_until):
         row = rows[i]
 
         for j, cell in enumerate(row):
+            if not cell or probe not in cell.upper():
+                continue
+
             if norm_group(cell) == target_group:
                 group_cols.append(j)
 
@@ -447,6 +746,9 @@ def find_header_and_group_cols(
             row = rows[i]
 
             for j, cell in enumerate(row):
+                if not cell or probe not in cell.upper():
+                    continue
+
                 normalized = norm_group(cell)
 
                 if target_group and target_group in normalized:
@@ -459,10 +761,8 @@ def find_header_and_group_cols(
 
         for i in range(min(50, len(rows))):
             for cell in rows[i]:
-                text = norm(cell)
-
-                if text.upper().startswith("ИГ"):
-                    seen_groups.add(text)
+                if cell.upper().startswith("ИГ"):
+                    seen_groups.add(cell)
 
         hint = ", ".join(sorted(seen_groups)) if seen_groups else "ничего похожего не найдено"
 
@@ -476,7 +776,7 @@ def find_header_and_group_cols(
 def should_skip_cell_text(text: str, group_name: str) -> bool:
     lowered = text.lower().strip()
     lowered = lowered.replace("ё", "е")
-    lowered = re.sub(r"\s+", " ", lowered)
+    lowered = WHITESPACE_RE.sub(" ", lowered)
 
     if not lowered:
         return True
@@ -484,20 +784,15 @@ def should_skip_cell_text(text: str, group_name: str) -> bool:
     if norm_group(text) == norm_group(group_name):
         return True
 
-    trash_fragments = (
-        "утверждаю",
-        "семестр",
-        "расписание",
-        "проректор",
-        "директор",
-        "учебный год",
-        "вид занятия",
-        "аудитория",
-        "вид занятия/аудитория",
-        "вид занятия / аудитория",
-    )
+    return TRASH_RE.search(lowered) is not None
+
+def append_or_glue(out: List[str], line: str) -> None:
+    if out and GLUE_RE.match(line):
+        # Обе строки уже сжаты, повторный compact_spaces не нужен
+        out[-1] = out[-1] + " " + line
+    else:
+        out.append(line)
 
-    return any(fragment in lowered for fragment in trash_fragments)
 
 def glue_markers_to_prev(lines: List[str]) -> List[str]:
     out: List[str] = []
@@ -505,50 +800,29 @@ def glue_markers_to_prev(lines: List[str]) -> List[str]:
     for raw in lines:
         line = compact_spaces(raw)
 
-        if not line:
-            continue
-
-        low = line.lower()
-
-        is_marker_alone = low in {"пр", "лек", "лаб", "сем"}
-        is_marker_start = bool(re.match(r"^(пр|лек|лаб|сем)\b", low))
-        is_slash_room = line.startswith("/")
-
-        if out and (is_marker_alone or is_marker_start or is_slash_room):
-            out[-1] = compact_spaces(out[-1] + " " + line)
-        else:
-            out.append(line)
+        if line:
+            append_or_glue(out, line)
 
     return out
 
 
 def cleanup_lines(parts: List[str], group_name: str) -> List[str]:
-    text = "\n".join(parts).strip()
-    raw_lines = [line.strip() for line in text.splitlines() if line.strip()]
-
-    filtered: List[str] = []
-
-    for line in raw_lines:
-        if should_skip_cell_text(line, group_name):
-            continue
-
-        filtered.append(line)
+    out: List[str] = []
 
-    filtered = glue_markers_to_prev(filtered)
+    for part in parts:
+        for raw in part.splitlines():
+            line = compact_spaces(raw)
 
-    uniq: List[str] = []
-    seen: Set[str] = set()
+            if not line or should_skip_cell_text(line, group_name):
+                continue
 
-    for line in filtered:
-        if line not in seen:
-            seen.add(line)
-            uniq.append(line)
+            append_or_glue(out, line)
 
-    return uniq
+    return list(dict.fromkeys(out))
 
 
 def time_sort_key(time_range: str) -> Tuple[int, int]:
-    match = re.match(r"^(\d{2}):(\d{2})", time_range or "")
+    match = TIME_START_RE.match(time_range or "")
 
     if not match:
         return (99, 99)
@@ -557,71 +831,56 @@ def time_sort_key(time_range: str) -> Tuple[int, int]:
 
 
 def merge_items_by_time(items: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
-    grouped: Dict[str, List[str]] = {}
-    order: List[str] = []
+    # dict вместо списка: порядок появления сохраняется, повторы отсекаются сами
+    grouped: Dict[str, Dict[str, None]] = {}
 
     for time_value, text_block in items:
-        if time_value not in grouped:
-            grouped[time_value] = []
-            order.append(time_value)
-
-        if text_block not in grouped[time_value]:
-            grouped[time_value].append(text_block)
-
-    ordered_times = sorted(order, key=time_sort_key)
+        grouped.setdefault(time_value, {})[text_block] = None
 
-    result: List[Tuple[str, str]] = []
-
-    for time_value in ordered_times:
-        result.append((time_value, "\n".join(grouped[time_value])))
-
-    return result
+    return [
+        (time_value, "\n".join(grouped[time_value]))
+        for time_value in sorted(grouped, key=time_sort_key)
+    ]
 
 
-def extract_schedule_for_date(
+def build_schedule_index(
     rows: List[List[str]],
     group_name: str,
-    target_ddmm: str,
-) -> List[Tuple[str, str]]:
-    header_idx, date_col, time_col, group_cols = find_header_and_group_cols(rows, group_name)
+    header: Optional[HeaderInfo] = None,
+) -> ScheduleIndex:
+    if header is None:
+        header = find_header_and_group_cols(rows, group_name)
+
+    header_idx, date_col, time_col, group_cols = header
 
     current_date: Optional[str] = None
     current_time: Optional[str] = None
-    items: List[Tuple[str, str]] = []
-    seen_pairs: Set[Tuple[str, str]] = set()
+    items_by_date: Dict[str, List[Tuple[str, str]]] = {}
 
-    max_needed_col = max([date_col, time_col] + group_cols)
+    body = pad_rows(rows[header_idx + 1:], max(date_col, time_col, *group_cols) + 1)
 
-    for raw_row in rows[header_idx + 1:]:
-        row = list(raw_row)
-
-        if len(row) <= max_needed_col:
-            row.extend([""] * (max_needed_col + 1 - len(row)))
-
-        date_value = norm(row[date_col])
-        time_value = norm(row[time_col])
-
-        parsed_date = parse_ddmm(date_value)
+    for date_value, time_value, group_values in zip(
+        map(itemgetter(date_col), body),
+        map(itemgetter(time_col), body),
+        map(columns_getter(group_cols), body),
+    ):
+        # Дата и время стоят только в первой строке пары/дня — пустые не разбираем
+        parsed_date = parse_ddmm(date_value) if date_value else None
 
         if parsed_date:
             current_date = parsed_date
 
-        parsed_time = normalize_time(time_value)
+        parsed_time = normalize_time(time_value) if time_value else None
 
         if parsed_time:
             current_time = parsed_time
 
-        if current_date != target_ddmm:
-            continue
-
-        if not current_time:
+        if not current_date or not current_time:
             continue
 
         parts: List[str] = []
 
-        for col in group_cols:
-            value = norm(row[col])
-
+        for value in group_values:
             if not value:
                 continue
 
@@ -643,35 +902,22 @@ def extract_schedule_for_date(
         if not text_block:
             continue
 
-        pair_key = (current_time, text_block)
+        # Повторы (время, текст) отбрасывает merge_items_by_time
+        items_by_date.setdefault(current_date, []).append((current_time, text_block))
 
-        if pair_key in seen_pairs:
-            continue
+    return {
+        ddmm: merge_items_by_time(items)
+        for ddmm, items in items_by_date.items()
+    }
 
-        seen_pairs.add(pair_key)
-        items.append(pair_key)
 
-    return merge_items_by_time(items)
+def format_pretty_date(ddmm: str) -> str:
+    day, month = ddmm.split(".")
+    return f"{int(day)} {MONTHS_GENITIVE.get(month, month)}"
 
 
 def format_schedule(group_name: str, ddmm: str, items: List[Tuple[str, str]]) -> str:
-    months = {
-        "01": "января",
-        "02": "февраля",
-        "03": "марта",
-        "04": "апреля",
-        "05": "мая",
-        "06": "июня",
-        "07": "июля",
-        "08": "августа",
-        "09": "сентября",
-        "10": "октября",
-        "11": "ноября",
-        "12": "декабря",
-    }
-
-    day, month = ddmm.split(".")
-    pretty_date = f"{int(day)} {months.get(month, month)}"
+    pretty_date = format_pretty_date(ddmm)
 
     if not items:
         return (
@@ -687,7 +933,7 @@ def format_schedule(group_name: str, ddmm: str, items: List[Tuple[str, str]]) ->
     ]
 
     for time_value, text_block in items:
-        lines = [line.strip() for line in text_block.splitlines() if line.strip()]
+        lines = [line for line in map(str.strip, text_block.splitlines()) if line]
         lines = glue_markers_to_prev(lines)
 
         if not lines:
@@ -709,6 +955,22 @@ def format_schedule(group_name: str, ddmm: str, items: List[Tuple[str, str]]) ->
 
     return "\n".join(out_lines)
 
+
+def format_schedule_cached(version: int, group_name: str, ddmm: str, index: ScheduleIndex) -> str:
+    key = (version, group_name, ddmm)
+    message = _FORMATTED_CACHE.pop(key, None)
+
+    if message is None:
+        message = format_schedule(group_name, ddmm, index.get(ddmm, []))
+
+    # Перевставка в конец: в начале словаря остаются давно не спрошенные ответы
+    _FORMATTED_CACHE[key] = message
+
+    while len(_FORMATTED_CACHE) > FORMATTED_CACHE_MAX:
+        del _FORMATTED_CACHE[next(iter(_FORMATTED_CACHE))]
+
+    return message
+
 # =========================
 # Расписание преподавателя
 # =========================
@@ -721,7 +983,7 @@ def looks_like_group_name(value: object) -> bool:
     if text.startswith("ИГ") and any(ch.isdigit() for ch in text):
         return True
 
-    if re.search(r"\b[А-ЯЁA-Z]{1,6}\d{2}-\d{2}", text):
+    if GROUP_CODE_RE.search(text):
         return True
 
     return False
@@ -729,27 +991,14 @@ def looks_like_group_name(value: object) -> bool:
 
 def find_header_and_all_group_cols(
     rows: List[List[str]],
-) -> Tuple[int, int, int, Dict[str, List[int]]]:
-    header_row_idx: Optional[int] = None
-    date_col: Optional[int] = None
-    time_col: Optional[int] = None
+) -> TeacherHeaderInfo:
+    header = find_header_row(rows)
 
-    for i in range(min(120, len(rows))):
-        row = [norm(cell) for cell in rows[i]]
-        row_lower = [cell.lower() for cell in row]
-
-        found_date_col = find_col_by_keywords(row_lower, ["дата"])
-        found_time_col = find_col_by_keywords(row_lower, ["часы", "время"])
-
-        if found_date_col is not None and found_time_col is not None:
-            header_row_idx = i
-            date_col = found_date_col
-            time_col = found_time_col
-            break
-
-    if header_row_idx is None or date_col is None or time_col is None:
+    if header is None:
         raise RuntimeError("Не удалось найти заголовки 'Дата' и 'Часы/Время' в таблице.")
 
+    header_row_idx, date_col, time_col = header
+
     group_to_cols: Dict[str, List[int]] = {}
     search_until = min(header_row_idx + 30, len(rows))
 
@@ -761,7 +1010,7 @@ def find_header_and_all_group_cols(
                 continue
 
             if looks_like_group_name(cell):
-                group_name = compact_spaces(norm(cell))
+                group_name = compact_spaces(cell)
                 group_to_cols.setdefault(group_name, [])
 
                 if j not in group_to_cols[group_name]:
@@ -779,91 +1028,113 @@ def find_header_and_all_group_cols(
     return header_row_idx, date_col, time_col, group_to_cols
 
 
-def extract_teacher_schedule_for_date(
-    rows: List[List[str]],
-    teacher_fio: str,
-    target_ddmm: str,
-) -> List[Tuple[str, str, str]]:
-    header_idx, date_col, time_col, group_to_cols = find_header_and_all_group_cols(rows)
-
-    teacher_norm = norm_teacher_text(teacher_fio)
+def build_date_ranges(rows: List[List[str]], header: TeacherHeaderInfo) -> DateRanges:
+    header_idx, date_col, time_col, _ = header
+    body_start = header_idx + 1
+    body = pad_rows(rows[body_start:], max(date_col, time_col) + 1)
 
+    ranges: DateRanges = {}
     current_date: Optional[str] = None
     current_time: Optional[str] = None
-    items: List[Tuple[str, str, str]] = []
-    seen: Set[Tuple[str, str, str]] = set()
+    range_start = 0
+    range_time: Optional[str] = None
 
-    all_cols: List[int] = [date_col, time_col]
+    for i, row in enumerate(body):
+        date_value = row[date_col]
+        time_value = row[time_col]
 
-    for cols in group_to_cols.values():
-        all_cols.extend(cols)
+        parsed_date = parse_ddmm(date_value) if date_value else None
 
-    max_needed_col = max(all_cols)
+        if parsed_date and parsed_date != current_date:
+            if current_date is not None:
+                ranges.setdefault(current_date, []).append(
+                    (body_start + range_start, body_start + i, range_time)
+                )
 
-    for raw_row in rows[header_idx + 1:]:
-        row = list(raw_row)
+            # Время могло остаться от предыдущего дня — запоминаем его для начала диапазона
+            current_date = parsed_date
+            range_start = i
+            range_time = current_time
 
-        if len(row) <= max_needed_col:
-            row.extend([""] * (max_needed_col + 1 - len(row)))
+        parsed_time = normalize_time(time_value) if time_value else None
 
-        date_value = norm(row[date_col])
-        time_value = norm(row[time_col])
+        if parsed_time:
+            current_time = parsed_time
 
-        parsed_date = parse_ddmm(date_value)
+    if current_date is not None:
+        ranges.setdefault(current_date, []).append(
+            (body_start + range_start, body_start + len(body), range_time)
+        )
 
-        if parsed_date:
-            current_date = parsed_date
+    return ranges
 
-        parsed_time = normalize_time(time_value)
 
-        if parsed_time:
-            current_time = parsed_time
+def extract_teacher_schedule_for_date(
+    rows: List[List[str]],
+    teacher_fio: str,
+    target_ddmm: str,
+    header: Optional[TeacherHeaderInfo] = None,
+    date_ranges: Optional[DateRanges] = None,
+) -> List[Tuple[str, str, str]]:
+    if header is None:
+        header = find_header_and_all_group_cols(rows)
 
-        if current_date != target_ddmm:
-            continue
+    if date_ranges is None:
+        date_ranges = build_date_ranges(rows, header)
 
-        if not current_time:
-            continue
+    _, date_col, time_col, group_to_cols = header
 
-        for group_name, group_cols in group_to_cols.items():
-            parts: List[str] = []
+    teacher_norm = norm_teacher_text(teacher_fio)
 
-            for col in group_cols:
-                value = norm(row[col])
+    found: Dict[Tuple[str, str, str], None] = {}
 
-                if not value:
-                    continue
+    # Колонки групп отсортированы, так что их максимум — последний элемент
+    width = max(date_col, time_col, *(cols[-1] for cols in group_to_cols.values())) + 1
 
-                if should_skip_cell_text(value, group_name):
-                    continue
+    for range_start, range_end, current_time in date_ranges.get(target_ddmm, []):
+        for row in pad_rows(rows[range_start:range_end], width):
+            time_value = row[time_col]
+            parsed_time = normalize_time(time_value) if time_value else None
 
-                parts.append(value)
+            if parsed_time:
+                current_time = parsed_time
 
-            if not parts:
+            if not current_time:
                 continue
 
-            lines = cleanup_lines(parts, group_name)
+            for group_name, group_cols in group_to_cols.items():
+                parts: List[str] = []
 
-            if not lines:
-                continue
+                for col in group_cols:
+                    value = row[col]
 
-            text_block = "\n".join(lines).strip()
+                    if not value:
+                        continue
 
-            if not text_block:
-                continue
+                    if should_skip_cell_text(value, group_name):
+                        continue
 
-            if teacher_norm not in norm_teacher_text(text_block):
-                continue
+                    parts.append(value)
 
-            key = (current_time, group_name, text_block)
+                if not parts:
+                    continue
 
-            if key in seen:
-                continue
+                lines = cleanup_lines(parts, group_name)
+
+                if not lines:
+                    continue
+
+                text_block = "\n".join(lines).strip()
 
-            seen.add(key)
-            items.append(key)
+                if not text_block:
+                    continue
+
+                if teacher_norm not in norm_teacher_text(text_block):
+                    continue
 
-    items.sort(key=lambda item: time_sort_key(item[0]))
+                found[(current_time, group_name, text_block)] = None
+
+    items = sorted(found, key=lambda item: time_sort_key(item[0]))
 
     return items
 
@@ -873,23 +1144,7 @@ def format_teacher_schedule(
     ddmm: str,
     items: List[Tuple[str, str, str]],
 ) -> str:
-    months = {
-        "01": "января",
-        "02": "февраля",
-        "03": "марта",
-        "04": "апреля",
-        "05": "мая",
-        "06": "июня",
-        "07": "июля",
-        "08": "августа",
-        "09": "сентября",
-        "10": "октября",
-        "11": "ноября",
-        "12": "декабря",
-    }
-
-    day, month = ddmm.split(".")
-    pretty_date = f"{int(day)} {months.get(month, month)}"
+    pretty_date = format_pretty_date(ddmm)
 
     if not items:
         return (
@@ -907,7 +1162,7 @@ def format_teacher_schedule(
     ]
 
     for time_value, group_name, text_block in items:
-        lines = [line.strip() for line in text_block.splitlines() if line.strip()]
+        lines = [line for line in map(str.strip, text_block.splitlines()) if line]
         lines = glue_markers_to_prev(lines)
 
         if not lines:
@@ -934,13 +1189,13 @@ def parse_teacher_date_from_args(args: List[str]) -> Optional[str]:
     raw = " ".join(args).strip().lower()
 
     if not raw:
-        return datetime.now(get_tz()).strftime("%d.%m")
+        return today_ddmm()
 
     if raw in {"сегодня", "today"}:
-        return datetime.now(get_tz()).strftime("%d.%m")
+        return today_ddmm()
 
     if raw in {"завтра", "tomorrow"}:
-        return (datetime.now(get_tz()) + timedelta(days=1)).strftime("%d.%m")
+        return today_ddmm(days=1)
 
     return parse_ddmm(raw)
 
@@ -1003,9 +1258,8 @@ async def send_schedule(update: Update, ddmm: str):
         return
 
     try:
-        rows = get_rows_with_cache(sheet_url, group_name, sheet_name)
-        items = extract_schedule_for_date(rows, group_name, ddmm)
-        message = format_schedule(group_name, ddmm, items)
+        version, index = await get_schedule_index_with_cache(sheet_url, group_name, sheet_name)
+        message = format_schedule_cached(version, group_name, ddmm, index)
         await reply_long(update, message)
 
     except Exception as exc:
@@ -1022,8 +1276,12 @@ async def send_teacher_schedule(update: Update, teacher_fio: str, ddmm: str):
         return
 
     try:
-        rows = get_rows_with_cache(sheet_url, group_name, sheet_name)
-        items = extract_teacher_schedule_for_date(rows, teacher_fio, ddmm)
+        rows, header, date_ranges = await get_teacher_rows_with_cache(
+            sheet_url,
+            group_name,
+            sheet_name,
+        )
+        items = extract_teacher_schedule_for_date(rows, teacher_fio, ddmm, header, date_ranges)
         message = format_teacher_schedule(teacher_fio, ddmm, items)
         await reply_long(update, message)
 
@@ -1051,12 +1309,12 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ddmm = datetime.now(get_tz()).strftime("%d.%m")
+    ddmm = today_ddmm()
     await send_schedule(update, ddmm)
 
 
 async def cmd_tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ddmm = (datetime.now(get_tz()) + timedelta(days=1)).strftime("%d.%m")
+    ddmm = today_ddmm(days=1)
     await send_schedule(update, ddmm)
 
 
@@ -1209,7 +1467,7 @@ async def cmd_prepod_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not teacher_fio:
         return
 
-    ddmm = datetime.now(get_tz()).strftime("%d.%m")
+    ddmm = today_ddmm()
     await send_teacher_schedule(update, teacher_fio, ddmm)
 
 
@@ -1219,7 +1477,7 @@ async def cmd_prepod_tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not teacher_fio:
         return
 
-    ddmm = (datetime.now(get_tz()) + timedelta(days=1)).strftime("%d.%m")
+    ddmm = today_ddmm(days=1)
     await send_teacher_schedule(update, teacher_fio, ddmm)
 
 
@@ -1242,29 +1500,19 @@ async def cmd_prepod_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await send_teacher_schedule(update, teacher_fio, ddmm)
-    if not ddmm:
-        await reply_long(
-            update,
-            "Формат команды:\n"
-            "/prepod\n"
-            "/prepod завтра\n"
-            "/prepod 30.01",
-        )
-        return
-
-    await send_teacher_schedule(update, teacher_fio, ddmm)
 
 
 async def text_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
 
-    text = (update.message.text or "").strip().lower()
+    text = (update.message.text or "").strip()
 
-    match = re.match(
-        r"^(?:день\s+)?(\d{1,2}[.\-/]\d{1,2}(?:[.\-/]\d{2,4})?)$",
-        text,
-    )
+    # "день 30.01.2025" короче этого; длинные сообщения не гоняем через регулярку
+    if len(text) > TEXT_DAY_MAX_LEN:
+        return
+
+    match = TEXT_DAY_RE.match(text.lower())
 
     if not match:
         return